@@ -0,0 +1,288 @@
+import errno
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+HASH_BUF_SIZE = 4 * 1024 * 1024
+
+# Below this many pairs a thread pool costs more than it saves
+PARALLEL_MIN_PAIRS = 4
+
+# Read buffer for the non-mmap hashing path, one per hashing thread
+_hash_tls = threading.local()
+
+ZIP_DEFLATE_LEVEL = 1
+ZIP_COPY_CHUNK = 1024 * 1024
+
+# Windows needs O_BINARY for os.open; it doesn't exist elsewhere
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+# Windows CopyFileExW: skip the cache for big files (like O_DIRECT)
+COPY_FILE_NO_BUFFERING = 0x00001000
+NO_BUFFERING_MIN = 1024 * 1024
+FILE_ATTRIBUTE_NORMAL = 0x80
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _CopyFileExW = _kernel32.CopyFileExW
+    _CopyFileExW.argtypes = [
+        wintypes.LPCWSTR,
+        wintypes.LPCWSTR,
+        wintypes.LPVOID,
+        wintypes.LPVOID,
+        ctypes.POINTER(wintypes.BOOL),
+        wintypes.DWORD,
+    ]
+    _CopyFileExW.restype = wintypes.BOOL
+    _SetFileAttributesW = _kernel32.SetFileAttributesW
+    _SetFileAttributesW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD]
+    _SetFileAttributesW.restype = wintypes.BOOL
+
+# Files smaller than this are stored; deflate barely helps and costs CPU
+ZIP_STORE_BELOW = 4096
+
+# Already compressed; deflating them again only burns CPU
+COMPRESSED_SUFFIXES = {".zip", ".7z", ".rar", ".gz", ".png", ".jpg", ".jpeg"}
+
+# 'Name {GUID}.xml' (BMS) or 'Name {GUID}.diff.lua' (DCS)
+GUID_FILENAME_RE = re.compile(r"^(?P<stem>.*)\s+\{[0-9A-Fa-f-]{36}\}(?:\.xml|\.diff\.lua)$")
+
+SHA_CACHE_NAME = ".sha_cache.json"
+
+# "path|size|mtime_ns" -> sha256, loaded from / saved to the sidecar file
+_sha_disk_cache: dict[str, str] = {}
+_sha_used: dict[str, str] = {}
+
+
+def guid_stem(name: str) -> Optional[str]:
+    """
+    Device name without the '{GUID}' tail and extension, or None if name has no GUID.
+    """
+    # Most filenames have no GUID at all; skip the regex for them
+    if "{" not in name:
+        return None
+    m = GUID_FILENAME_RE.match(name)
+    if m:
+        return m.group("stem").strip()
+    return None
+
+
+def sha256_file(p: Path) -> str:
+    with p.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hashlib.sha256().hexdigest()
+        try:
+            # Hash the whole file in one C call instead of a Python read loop
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).hexdigest()
+        except (OSError, ValueError):
+            # mmap can fail on network shares; fall back to chunked reads
+            f.seek(0)
+            view = getattr(_hash_tls, "view", None)
+            if view is None:
+                view = _hash_tls.view = memoryview(bytearray(HASH_BUF_SIZE))
+            h = hashlib.sha256()
+            while n := f.readinto(view):
+                h.update(view[:n])
+            return h.hexdigest()
+
+
+def quick_equal(a: Path, b: Path) -> Optional[bool]:
+    """
+    Cheap metadata comparison before hashing.
+    False if sizes differ, None if undecided (caller falls back to SHA-256).
+    Matching mtimes prove nothing here: a and b are different files that can be
+    written in the same second with different content.
+    """
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    return None
+
+
+@lru_cache(maxsize=8192)
+def _sha_cached(path_str: str, size: int, mtime_ns: int) -> str:
+    key = f"{path_str}|{size}|{mtime_ns}"
+    digest = _sha_disk_cache.get(key)
+    if digest is None:
+        digest = sha256_file(Path(path_str))
+    _sha_used[key] = digest
+    return digest
+
+
+def cached_sha256(p: Path) -> str:
+    """
+    sha256_file, memoized by (path, size, mtime_ns).
+    A changed file gets a new key, so stale entries are never trusted.
+    """
+    st = p.stat()
+    return _sha_cached(str(p), st.st_size, st.st_mtime_ns)
+
+
+def _copy_file_range(src: Path, dst: Path) -> bool:
+    """
+    Linux: copy the whole file in-kernel with copy_file_range (reflinks on btrfs/XFS).
+    Returns False if the kernel or filesystem doesn't support it.
+    """
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        size = remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if n == 0:
+                    # Some filesystems report 0 without copying anything (like shutil, fall back)
+                    if remaining == size:
+                        return False
+                    raise OSError(f"copy_file_range stopped early: {src} -> {dst}")
+                remaining -= n
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            raise
+    return True
+
+
+def fast_copy(src: Path, dst: Path) -> None:
+    """
+    Copy src over dst. On Windows the copy runs in-kernel through CopyFileExW,
+    on Linux through copy_file_range; elsewhere this is shutil.copyfile.
+    Like shutil.copyfile only the data is copied: CopyFileExW also carries over the
+    attributes and timestamps of src, so those are reset on dst afterwards. Otherwise a
+    read-only backup would become a read-only live config.
+    """
+    if sys.platform == "win32":
+        flags = COPY_FILE_NO_BUFFERING if src.stat().st_size >= NO_BUFFERING_MIN else 0
+        if not _CopyFileExW(str(src), str(dst), None, None, None, flags):
+            raise ctypes.WinError(ctypes.get_last_error())
+        if not _SetFileAttributesW(str(dst), FILE_ATTRIBUTE_NORMAL):
+            raise ctypes.WinError(ctypes.get_last_error())
+        os.utime(dst)
+        return
+    if hasattr(os, "copy_file_range") and _copy_file_range(src, dst):
+        return
+    shutil.copyfile(src, dst)
+
+
+def replace_content(src: Path, dst: Path) -> None:
+    """
+    Overwrite dst with the content of src through a temp file and an atomic rename.
+    On success os.replace has consumed the temp file, so it is only cleaned up on failure.
+    """
+    tmp = dst.with_suffix(dst.suffix + ".tmp")
+    try:
+        fast_copy(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            tmp.unlink(missing_ok=True)
+        except OSError:
+            pass
+        raise
+
+
+def compare_pairs(pairs: list[tuple[Path, Path]]) -> dict[tuple[Path, Path], bool]:
+    """
+    (a, b) -> True if both files have the same content.
+    Pairs whose sizes differ are decided by quick_equal; the rest are hashed on a thread pool
+    (hashlib releases the GIL, and the reads overlap).
+    """
+    result: dict[tuple[Path, Path], bool] = {}
+    undecided: list[tuple[Path, Path]] = []
+    for pair in pairs:
+        same = quick_equal(*pair)
+        if same is None:
+            undecided.append(pair)
+        else:
+            result[pair] = same
+
+    paths = [p for pair in undecided for p in pair]
+    if len(undecided) < PARALLEL_MIN_PAIRS:
+        digests = [cached_sha256(p) for p in paths]
+    else:
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+            digests = list(ex.map(cached_sha256, paths))
+
+    for i, pair in enumerate(undecided):
+        result[pair] = digests[2 * i] == digests[2 * i + 1]
+    return result
+
+
+def load_sha_cache(folder: Path) -> None:
+    try:
+        data = json.loads((folder / SHA_CACHE_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return
+    if isinstance(data, dict):
+        _sha_disk_cache.update(data)
+
+
+def save_sha_cache(folder: Path) -> None:
+    # Only keep entries seen this run, so files that went away drop out
+    try:
+        (folder / SHA_CACHE_NAME).write_text(json.dumps(_sha_used), encoding="utf-8")
+    except OSError as e:
+        print(f"[WARN] Could not write hash cache: {e}")
+
+
+def _walk_files(src_dir: str):
+    """
+    Yield (dirpath, filename, dir_fd). dir_fd lets POSIX open/stat entries relative to their
+    directory; it is None where os.fwalk doesn't exist (Windows).
+    """
+    if hasattr(os, "fwalk"):
+        for root, _, files, dirfd in os.fwalk(src_dir):
+            for fname in files:
+                yield root, fname, dirfd
+    else:
+        for root, _, files in os.walk(src_dir):
+            for fname in files:
+                yield root, fname, None
+
+
+def _zipinfo_from_stat(arcname: str, st: os.stat_result) -> ZipInfo:
+    # Same fields ZipInfo.from_file fills in, but from a stat we already have
+    zinfo = ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    return zinfo
+
+
+def write_folder_zip(src_dir: Path, zip_path: Path) -> None:
+    """
+    Zip every file under src_dir into zip_path.
+    Small and already-compressed files are stored, the rest is deflated at level 1.
+    """
+    src = os.fspath(src_dir)
+    with ZipFile(zip_path, "w", compression=ZIP_DEFLATED, compresslevel=ZIP_DEFLATE_LEVEL) as zf:
+        own = os.fstat(zf.fp.fileno())
+        for root, fname, dirfd in _walk_files(src):
+            path = fname if dirfd is not None else os.path.join(root, fname)
+            st = os.stat(path, dir_fd=dirfd)
+            # zip_path may live inside src_dir; don't zip it into itself
+            if os.path.samestat(st, own):
+                continue
+
+            zinfo = _zipinfo_from_stat(os.path.relpath(os.path.join(root, fname), src), st)
+            if (os.path.splitext(fname)[1].lower() not in COMPRESSED_SUFFIXES
+                    and st.st_size >= ZIP_STORE_BELOW):
+                zinfo.compress_type = ZIP_DEFLATED
+                zinfo._compresslevel = ZIP_DEFLATE_LEVEL
+
+            # Stream straight into the archive entry with one large buffer
+            fd = os.open(path, os.O_RDONLY | _O_BINARY, dir_fd=dirfd)
+            with os.fdopen(fd, "rb") as fsrc, zf.open(zinfo, "w") as dst:
+                shutil.copyfileobj(fsrc, dst, ZIP_COPY_CHUNK)
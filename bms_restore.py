@@ -1,15 +1,20 @@
 import configparser
-import hashlib
 import os
-import re
 import shutil
 import sys
+import time
 from dataclasses import dataclass
-from datetime import datetime
 from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
+from typing import Optional, Union
 
-GUID_FILENAME_RE = re.compile(r"^(?P<stem>.*)\s+\{[0-9A-Fa-f-]{36}\}\.xml$")
+from _common import (
+    compare_pairs,
+    guid_stem,
+    load_sha_cache,
+    replace_content,
+    save_sha_cache,
+    write_folder_zip,
+)
 
 
 @dataclass(frozen=True)
@@ -20,6 +25,15 @@ class Settings:
     zip_destination: str  # "backup_dir" or "bms_config_dir"
     copy_if_missing: bool
 
+
+@dataclass(frozen=True)
+class RestoreItem:
+    key: str
+    backup_file: Path
+    target: Optional[Path]  # None if there is no matching file in BMS
+    identical: bool
+
+
 def rel_display(path: Path, base: Path) -> str:
     try:
         return str(path.relative_to(base))
@@ -82,44 +96,51 @@ def normalize_key(xml_filename: str) -> str:
       'Setup.v100.WINCTRL ...'
     If it doesn't match the GUID pattern, fall back to the plain stem.
     """
-    m = GUID_FILENAME_RE.match(xml_filename)
-    if m:
-        return m.group("stem").strip()
+    stem = guid_stem(xml_filename)
+    if stem is not None:
+        return stem
     # fallback: remove trailing ".xml"
-    return Path(xml_filename).stem.strip()
+    return os.path.splitext(xml_filename)[0].strip()
 
 
-def sha256_file(p: Path) -> str:
-    h = hashlib.sha256()
-    with p.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-
-def list_xml_files(folder: Path) -> list[Path]:
-    if not folder.exists():
+def scan_xml_entries(folder: Path) -> list[os.DirEntry]:
+    """
+    XML files directly in folder, sorted by name.
+    os.scandir gives us the file type from the directory listing, so no extra stat per entry.
+    """
+    try:
+        with os.scandir(folder) as it:
+            out = [e for e in it if e.name.lower().endswith(".xml") and e.is_file()]
+    except FileNotFoundError:
         return []
-    return sorted([p for p in folder.iterdir() if p.is_file() and p.suffix.lower() == ".xml"])
+    out.sort(key=lambda e: e.name)
+    return out
 
 
-def build_index(folder: Path) -> dict[str, list[Path]]:
+def build_index(folder: Path) -> dict[str, Union[Path, list[Path]]]:
     """
-    key -> list of matching files (usually 1)
+    key -> matching file, or a list of files if the key is ambiguous (rare)
     """
-    idx: dict[str, list[Path]] = {}
-    for p in list_xml_files(folder):
-        k = normalize_key(p.name)
-        idx.setdefault(k, []).append(p)
+    idx: dict[str, Union[Path, list[Path]]] = {}
+    for e in scan_xml_entries(folder):
+        k = normalize_key(e.name)
+        p = Path(e.path)
+        prev = idx.get(k)
+        if prev is None:
+            idx[k] = p
+        elif isinstance(prev, list):
+            prev.append(p)
+        else:
+            idx[k] = [prev, p]
     return idx
 
 
-def choose_target(paths: list[Path]) -> Path:
+def choose_target(paths: Union[Path, list[Path]]) -> Path:
     """
     If there are multiple candidates, pick the newest modified one.
     """
-    if len(paths) == 1:
-        return paths[0]
+    if isinstance(paths, Path):
+        return paths
     return max(paths, key=lambda p: p.stat().st_mtime)
 
 
@@ -128,43 +149,70 @@ def make_zip_of_bms_config(settings: Settings) -> Path:
     dest_dir = settings.backup_dir.parent
     dest_dir.mkdir(parents=True, exist_ok=True)
 
-    ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    ts = time.strftime("%Y-%m-%d_%H-%M-%S")
     zip_path = dest_dir / f"{settings.zip_name_prefix}.{ts}.zip"
 
-    with ZipFile(zip_path, "w", compression=ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(src_dir):
-            root_path = Path(root)
-            for fname in files:
-                full_path = root_path / fname
-                rel_path = full_path.relative_to(src_dir)
-                zf.write(full_path, arcname=rel_path)
+    write_folder_zip(src_dir, zip_path)
 
     print(f"[ZIP] Wrote full folder backup: {zip_path}")
     return zip_path
 
 
-def restore_from_backups(settings: Settings, dry_run) -> None:
+def plan_restores(settings: Settings) -> list[RestoreItem]:
+    """
+    Match every backup file to its BMS target and check whether the content differs.
+    Reads only, changes nothing on disk.
+    """
     backup_dir = settings.backup_dir
     bms_dir = settings.bms_config_dir
 
     if not backup_dir.exists():
         print(f"[WARN] Backup dir does not exist: {backup_dir}")
-        return
+        return []
     if not bms_dir.exists():
         raise FileNotFoundError(f"BMS config dir does not exist: {bms_dir}")
 
+    load_sha_cache(backup_dir)
     backup_index = build_index(backup_dir)
     bms_index = build_index(bms_dir)
 
+    # Pair up backup and target files first, so the content checks can run in parallel
+    matches = []
+    for key, backup_files in backup_index.items():
+        targets = bms_index.get(key)
+        target = choose_target(targets) if targets else None
+        matches.append((key, choose_target(backup_files), target))
+    compared = compare_pairs([(b, t) for _, b, t in matches if t is not None])
+
+    return [
+        RestoreItem(key, backup_file, target, target is not None and compared[(backup_file, target)])
+        for key, backup_file, target in matches
+    ]
+
+
+def needs_changes(plan: list[RestoreItem], settings: Settings) -> bool:
+    """
+    True if applying the plan (in replace mode) would write anything into the BMS folder.
+    """
+    for item in plan:
+        if item.target is None:
+            if settings.copy_if_missing:
+                return True
+        elif not item.identical:
+            return True
+    return False
+
+
+def apply_restores(settings: Settings, plan: list[RestoreItem], dry_run) -> None:
+    bms_dir = settings.bms_config_dir
+
     restored = 0
     identical = 0
     missing = 0
 
-    for key, backup_files in backup_index.items():
-        backup_file = choose_target(backup_files)
-
-        targets = bms_index.get(key, [])
-        if not targets:
+    for item in plan:
+        key, backup_file, target = item.key, item.backup_file, item.target
+        if target is None:
             missing += 1
             if settings.copy_if_missing:
                 dest = bms_dir / backup_file.name
@@ -174,41 +222,22 @@ def restore_from_backups(settings: Settings, dry_run) -> None:
                 print(f"[MISS] No matching target in BMS for: '{key}'")
             continue
 
-        target = choose_target(targets)
-
-        hb = sha256_file(backup_file)
-        ht = sha256_file(target)
-        if hb == ht:
+        if item.identical:
             identical += 1
             # No need to spam too much, but keep one line:
             print(f"[OK]   {target.name} already matches backup")
             continue
 
         # Overwrite CONTENT only, keep target filename (incl. new GUID)
-        tmp = target.with_suffix(target.suffix + ".tmp")
-        try:
-            if dry_run:
-                print(f"[DRYRUN] Would restore -> {rel_display(target, bms_dir)}")
-            else:
-                tmp = target.with_suffix(target.suffix + ".tmp")
-                try:
-                    shutil.copyfile(backup_file, tmp)
-                    os.replace(tmp, target)
-                    print(f"[FIX]  Restored -> {rel_display(target, bms_dir)}")
-                finally:
-                    if tmp.exists():
-                        try:
-                            tmp.unlink()
-                        except OSError:
-                            pass
-
-            restored += 1
-        finally:
-            if tmp.exists():
-                try:
-                    tmp.unlink()
-                except OSError:
-                    pass
+        if dry_run:
+            print(f"[DRYRUN] Would restore -> {rel_display(target, bms_dir)}")
+        else:
+            replace_content(backup_file, target)
+            print(f"[FIX]  Restored -> {rel_display(target, bms_dir)}")
+        restored += 1
+
+    if not dry_run:
+        save_sha_cache(settings.backup_dir)
 
     print("")
     print("[SUMMARY]")
@@ -250,12 +279,18 @@ def main() -> int:
     if not settings.backup_dir.exists():
         print(f"[WARN] backup_dir not found yet (ok if empty/new): {settings.backup_dir}")
 
-    # Step 1: zip current BMS config XMLs
+    # Step 1: find out what would change
+    plan = plan_restores(settings)
+
+    # Step 2: zip current BMS config XMLs, unless nothing is going to be touched
     if not dry_run:
-        make_zip_of_bms_config(settings)
+        if needs_changes(plan, settings):
+            make_zip_of_bms_config(settings)
+        else:
+            print("[OK] No changes needed, skipping backup zip")
 
-    # Step 2: restore from backups (content replacement keeping new filename/GUID)
-    restore_from_backups(settings, dry_run)
+    # Step 3: restore from backups (content replacement keeping new filename/GUID)
+    apply_restores(settings, plan, dry_run)
     pause_exit()
     return 0
 
@@ -1,15 +1,25 @@
 import configparser
-import hashlib
 import os
 import shutil
 import sys
-import re
+import time
 from dataclasses import dataclass
-from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
 
-GUID_DIFF_RE = re.compile(r"^(?P<stem>.*)\s+\{[0-9A-Fa-f-]{36}\}\.diff\.lua$")
+from _common import (
+    cached_sha256,
+    compare_pairs,
+    guid_stem,
+    load_sha_cache,
+    quick_equal,
+    replace_content,
+    save_sha_cache,
+    write_folder_zip,
+)
+
+# Per-aircraft input folders that never hold joystick bindings; not descended into
+NON_JOYSTICK_DIRS = {"keyboard", "mouse", "trackir", "headtracker"}
 
 
 @dataclass(frozen=True)
@@ -67,14 +77,6 @@ def read_settings(config_path: Path) -> Settings:
     )
 
 
-def sha256_file(p: Path) -> str:
-    h = hashlib.sha256()
-    with p.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-
 def normalize_guid_filename(name: str) -> str:
     """
     Turn:
@@ -83,10 +85,10 @@ def normalize_guid_filename(name: str) -> str:
       'WINWING ICP'
     If it doesn't match, return the filename as-is.
     """
-    m = GUID_DIFF_RE.match(name)
-    if m:
-        return m.group("stem").strip()
-    return name
+    if not name.endswith(".diff.lua"):
+        return name
+    stem = guid_stem(name)
+    return name if stem is None else stem
 
 
 def choose_target(candidates: list[Path]) -> Path:
@@ -98,19 +100,49 @@ def choose_target(candidates: list[Path]) -> Path:
     return max(candidates, key=lambda p: p.stat().st_mtime)
 
 
+@lru_cache(maxsize=None)
+def target_index(folder: Path) -> dict[str, list[Path]]:
+    """
+    normalized device name -> *.diff.lua files in folder, built once per folder.
+    Call target_index.cache_clear() after adding files to a folder.
+    """
+    idx: dict[str, list[Path]] = {}
+    with os.scandir(folder) as it:
+        for e in it:
+            if e.name.endswith(".diff.lua") and e.is_file():
+                k = normalize_guid_filename(e.name)
+                idx.setdefault(k, []).append(Path(e.path))
+    return idx
+
+
+def iter_joystick_diffs(backup_root: Path):
+    """
+    Yield GUID *.diff.lua files that live in a 'joystick' folder, in sorted order.
+    Only the survivors are turned into Path objects.
+    """
+    for root, dirs, files in os.walk(backup_root):
+        dirs[:] = sorted(d for d in dirs if d.lower() not in NON_JOYSTICK_DIRS)
+
+        # Strongly recommended: only joystick device bindings (not keyboard/mouse)
+        if os.path.basename(root).lower() != "joystick":
+            continue
+
+        for fname in sorted(files):
+            # Only handle device-specific diff files with GUID in filename
+            if not fname.endswith(".diff.lua"):
+                continue
+            if guid_stem(fname) is None:
+                continue
+            yield Path(root, fname)
+
+
 def zip_entire_folder(src_dir: Path, dest_dir: Path, prefix: str) -> Path:
     dest_dir.mkdir(parents=True, exist_ok=True)
 
-    ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    ts = time.strftime("%Y-%m-%d_%H-%M-%S")
     zip_path = dest_dir / f"{prefix}.{ts}.zip"
 
-    with ZipFile(zip_path, "w", compression=ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(src_dir):
-            root_path = Path(root)
-            for fname in files:
-                full_path = root_path / fname
-                rel_path = full_path.relative_to(src_dir)
-                zf.write(full_path, arcname=rel_path)
+    write_folder_zip(src_dir, zip_path)
 
     print(f"[ZIP] Wrote full folder backup: {zip_path}")
     return zip_path
@@ -125,31 +157,30 @@ def restore_dcs(settings: Settings, dry_run) -> None:
     if not dcs_root.exists():
         raise FileNotFoundError(f"dcs_input_dir does not exist: {dcs_root}")
 
+    load_sha_cache(backup_root)
+
     restored = 0
     identical = 0
     missing = 0
     copied_missing = 0
 
-    # Walk every file in backup tree and apply to matching location in DCS tree
-    for backup_file in sorted(backup_root.rglob("*")):
-        if not backup_file.is_file():
-            continue
-
-        # Skip zip artifacts (and any other non-binding files)
-        if backup_file.suffix.lower() == ".zip":
-            continue
-
-        # Only handle device-specific diff files with GUID in filename
-        if backup_file.suffixes[-2:] != [".diff", ".lua"]:
-            continue
-        if not GUID_DIFF_RE.match(backup_file.name):
-            continue
+    backup_files = list(iter_joystick_diffs(backup_root))
 
-        # Strongly recommended: only joystick device bindings (not keyboard/mouse)
-        if backup_file.parent.name.lower() != "joystick":
+    # Pair up backup and target files first, so the content checks can run in parallel
+    pairs = []
+    for backup_file in backup_files:
+        target_parent = dcs_root / backup_file.parent.relative_to(backup_root)
+        if not target_parent.is_dir():
             continue
-
-
+        candidates = target_index(target_parent).get(normalize_guid_filename(backup_file.name))
+        if candidates:
+            pairs.append((backup_file, choose_target(candidates)))
+    compared = compare_pairs(pairs)
+    # Targets rewritten during this run; their prefetched comparisons are stale
+    written = set()
+
+    # Walk joystick diff files in backup tree and apply to matching location in DCS tree
+    for backup_file in backup_files:
         rel = backup_file.relative_to(backup_root)
         target_parent = dcs_root / rel.parent
 
@@ -167,18 +198,11 @@ def restore_dcs(settings: Settings, dry_run) -> None:
             continue
 
         # GUID-based diff.lua: match by stem within same folder
-        if backup_file.suffixes[-2:] == [".diff", ".lua"] and GUID_DIFF_RE.match(backup_file.name):
+        if backup_file.name.endswith(".diff.lua") and guid_stem(backup_file.name) is not None:
             key = normalize_guid_filename(backup_file.name)
 
             # Find candidates in target folder with same normalized name
-            candidates = []
-            for p in target_parent.iterdir():
-                if not p.is_file():
-                    continue
-                if p.suffixes[-2:] != [".diff", ".lua"]:
-                    continue
-                if normalize_guid_filename(p.name) == key:
-                    candidates.append(p)
+            candidates = target_index(target_parent).get(key, [])
 
             if not candidates:
                 missing += 1
@@ -186,6 +210,7 @@ def restore_dcs(settings: Settings, dry_run) -> None:
                     # No target GUID exists; copy backup as-is (backup GUID filename)
                     dest = target_parent / backup_file.name
                     shutil.copy2(backup_file, dest)
+                    target_index.cache_clear()
                     copied_missing += 1
                     print(f"[COPY] No target match -> copied backup file: {rel.as_posix()}")
                 else:
@@ -194,29 +219,24 @@ def restore_dcs(settings: Settings, dry_run) -> None:
 
             target_file = choose_target(candidates)
 
-            hb = sha256_file(backup_file)
-            ht = sha256_file(target_file)
-            if hb == ht:
+            pair = (backup_file, target_file)
+            same = compared.get(pair)
+            if same is None or target_file in written:
+                # Target appeared or changed through a write earlier in this run
+                same = compare_pairs([pair])[pair]
+            if same:
                 identical += 1
                 print(f"[OK]   {target_file.relative_to(dcs_root).as_posix()} already matches backup")
                 continue
 
             # Replace content while keeping target filename/GUID
-            tmp = target_file.with_suffix(target_file.suffix + ".tmp")
-            try:
-                if dry_run:
-                    print(f"[DRYRUN] Would restore -> {target_file.relative_to(dcs_root)}")
-                else:
-                    shutil.copyfile(backup_file, tmp)
-                    os.replace(tmp, target_file)
-                    print(f"[FIX]  Restored -> {target_file.relative_to(dcs_root)}")
-                restored += 1
-            finally:
-                if tmp.exists():
-                    try:
-                        tmp.unlink()
-                    except OSError:
-                        pass
+            if dry_run:
+                print(f"[DRYRUN] Would restore -> {target_file.relative_to(dcs_root)}")
+            else:
+                replace_content(backup_file, target_file)
+                written.add(target_file)
+                print(f"[FIX]  Restored -> {target_file.relative_to(dcs_root)}")
+            restored += 1
 
         else:
             # Non-GUID file: match exact relative path
@@ -232,30 +252,26 @@ def restore_dcs(settings: Settings, dry_run) -> None:
                     print(f"[MISS] Missing file: {rel.as_posix()}")
                 continue
 
-            hb = sha256_file(backup_file)
-            ht = sha256_file(target_file)
-            if hb == ht:
+            # size first, only hash when sizes match
+            same = quick_equal(backup_file, target_file)
+            if same is None:
+                same = cached_sha256(backup_file) == cached_sha256(target_file)
+            if same:
                 identical += 1
                 # keep quiet-ish:
                 print(f"[OK]   {rel.as_posix()} already matches backup")
                 continue
 
-            tmp = target_file.with_suffix(target_file.suffix + ".tmp")
-            try:
-                if dry_run:
-                    print(f"[DRYRUN] Would restore -> {target_file.relative_to(dcs_root)}")
-                else:
-                    shutil.copyfile(backup_file, tmp)
-                    os.replace(tmp, target_file)
-                    print(f"[FIX]  Restored -> {target_file.relative_to(dcs_root)}")
-                restored += 1
-                print(f"[FIX]  Restored -> {rel.as_posix()}")
-            finally:
-                if tmp.exists():
-                    try:
-                        tmp.unlink()
-                    except OSError:
-                        pass
+            if dry_run:
+                print(f"[DRYRUN] Would restore -> {target_file.relative_to(dcs_root)}")
+            else:
+                replace_content(backup_file, target_file)
+                print(f"[FIX]  Restored -> {target_file.relative_to(dcs_root)}")
+            restored += 1
+            print(f"[FIX]  Restored -> {rel.as_posix()}")
+
+    if not dry_run:
+        save_sha_cache(backup_root)
 
     print("")
     print("[SUMMARY]")
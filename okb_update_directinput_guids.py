@@ -6,23 +6,34 @@
 # - Enumerates attached DirectInput devices via IDirectInput8A
 # - Matches by (Kind, Name) with strict exact match after normalization
 # - Updates volatile GUIDs (dict key + "ID")
-# - One ZIP backup per run (always created if there are pending changes)
+# - One ZIP backup per run (REPLACE mode, if there are pending changes)
 # - Interactive Dry-Run / Replace
 # - DRY-RUN prints exactly what would change
-# - Waits for ENTER before exit
+# - Waits for ENTER before exit (unless --yes / --dry-run)
 #
-# Windows-only, no external dependencies
+# Windows-only, no external dependencies (orjson is used if installed)
 # ============================================================
 
+import argparse
 import ctypes
+import functools
+import hashlib
+import io
 import json
-import zipfile
+import os
 import configparser
 import uuid
 import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import wintypes
 from pathlib import Path
-from datetime import datetime
+
+# Optional: much faster JSON encoding if installed, stdlib json otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ============================================================
 # Defaults (hard-coded)
@@ -32,6 +43,13 @@ ZIP_PREFIX = "okb_directinput"
 DEFAULT_DRY_RUN = True
 CASE_INSENSITIVE_NAMES = True
 NORMALIZE_WHITESPACE = True
+# Backups smaller than this (total) are stored uncompressed
+ZIP_STORE_BELOW_TOTAL = 4 << 20
+# zlib level when zstd isn't available; level 1 is several times faster than the default 6
+ZIP_DEFLATE_LEVEL = 1
+ZIP_WRITE_BUFFER = 1 << 20
+# Kept in backup_root: files known to need no change, so later runs skip parsing them
+UNCHANGED_CACHE_NAME = ".restore_joystick_cache.json"
 
 # ============================================================
 # Windows / DirectInput types
@@ -89,23 +107,16 @@ def guid_from_string_py(s: str) -> GUID:
     u = uuid.UUID(s)
 
     b = u.bytes_le
-    data1, data2, data3 = struct.unpack("<IHH", b[:8])
 
     g = GUID()
-    g.Data1 = data1
-    g.Data2 = data2
-    g.Data3 = data3
-    for i in range(8):
-        g.Data4[i] = b[8 + i]
+    g.Data1, g.Data2, g.Data3 = struct.unpack_from("<IHH", b, 0)
+    ctypes.memmove(g.Data4, b[8:], 8)
     return g
 
 def guid_to_string(g: GUID) -> str:
-    d4 = bytes(g.Data4)
-    return (
-        f"{{{g.Data1:08x}-{g.Data2:04x}-{g.Data3:04x}-"
-        f"{d4[0]:02x}{d4[1]:02x}-"
-        f"{d4[2]:02x}{d4[3]:02x}{d4[4]:02x}{d4[5]:02x}{d4[6]:02x}{d4[7]:02x}}}"
-    ).upper()
+    # Big-endian Data1..3 followed by Data4 is the canonical textual byte order
+    h = (struct.pack(">IHH", g.Data1, g.Data2, g.Data3) + bytes(g.Data4)).hex().upper()
+    return f"{{{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}}}"
 
 def kind_from_dwDevType(dwDevType: int) -> str:
     t = dwDevType & 0xFF
@@ -123,13 +134,26 @@ def kind_from_dwDevType(dwDevType: int) -> str:
         return "GameController"
     return "Other"
 
+@functools.lru_cache(maxsize=1024)
 def normalize_name(name: str) -> str:
-    s = name
-    if NORMALIZE_WHITESPACE:
-        s = " ".join(s.split())
-    if CASE_INSENSITIVE_NAMES:
-        s = s.casefold()
-    return s
+    # Cached: the same few device names repeat across every DirectInput.json.
+    # Interned, so device_map keys and lookups share one string object and compare by identity.
+    s = " ".join(name.split()) if NORMALIZE_WHITESPACE else name
+    return sys.intern(s.casefold() if CASE_INSENSITIVE_NAMES else s)
+
+if orjson is not None:
+    def dump_json(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+else:
+    def dump_json(obj) -> bytes:
+        return (json.dumps(obj, indent=2) + "\n").encode("utf-8")
+
+def root_prefix(root: Path) -> str:
+    """
+    str(root) with exactly one trailing separator. Every file found below root starts
+    with it, so str(p)[len(prefix):] is the relative path without Path.relative_to.
+    """
+    return str(root).rstrip(os.sep) + os.sep
 
 def decode_ansi(b: bytes) -> str:
     return b.split(b"\x00", 1)[0].decode("mbcs", errors="replace").strip()
@@ -176,7 +200,9 @@ def load_ini():
     if "paths" not in cfg:
         raise SystemExit("INI missing [paths] section")
 
-    okb_root = Path(cfg["paths"]["openkneeboard_root"]).expanduser()
+    # Resolved so root_prefix and the walked file paths share one normalized form
+    # (a relative root like "." or a drive-relative "C:" would otherwise not match)
+    okb_root = Path(cfg["paths"]["openkneeboard_root"]).expanduser().resolve()
     backup_root = Path(cfg["paths"]["backup_root"]).expanduser()
 
     if not okb_root.exists():
@@ -185,6 +211,25 @@ def load_ini():
     backup_root.mkdir(parents=True, exist_ok=True)
     return okb_root, backup_root
 
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Update volatile DirectInput GUIDs in OpenKneeboard configs.")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--yes", action="store_true",
+                      help="don't prompt: run in REPLACE mode and exit without waiting for ENTER")
+    mode.add_argument("--dry-run", action="store_true",
+                      help="don't prompt: run in DRY-RUN mode and exit without waiting for ENTER")
+    ap.add_argument("-j", "--jobs", type=positive_int, default=None,
+                    help="worker threads for reading/writing DirectInput.json files")
+    ap.add_argument("--quiet", action="store_true", help="don't print the planned changes")
+    ap.add_argument("--no-backup", action="store_true", help="don't write the ZIP backup")
+    return ap.parse_args(argv)
+
 # ============================================================
 # DirectInput enumeration (IDirectInput8A)
 # ============================================================
@@ -233,11 +278,22 @@ def enumerate_directinput_devices():
 
     Release = ctypes.WINFUNCTYPE(wintypes.ULONG, ctypes.c_void_p)(vtbl[2])
 
-    results = {}
+    # The callback only copies the raw struct; decoding happens after enumeration
+    instances = []
 
     @EnumDevicesCallbackA
     def cb(pinst, _ref):
-        inst = pinst.contents
+        instances.append(DIDEVICEINSTANCEA.from_buffer_copy(pinst.contents))
+        return True
+
+    hr = EnumDevices(di_ptr, DI8DEVCLASS_ALL, cb, None, DIEDFL_ATTACHEDONLY)
+    Release(di_ptr)
+
+    if hr < 0:
+        raise RuntimeError(f"EnumDevices failed (HRESULT=0x{hr & 0xFFFFFFFF:08X})")
+
+    results = {}
+    for inst in instances:
         kind = kind_from_dwDevType(inst.dwDevType)
 
         product = decode_ansi(bytes(inst.tszProductName))
@@ -246,13 +302,6 @@ def enumerate_directinput_devices():
 
         key = (kind, normalize_name(name))
         results.setdefault(key, []).append(guid_to_string(inst.guidInstance))
-        return True
-
-    hr = EnumDevices(di_ptr, DI8DEVCLASS_ALL, cb, None, DIEDFL_ATTACHEDONLY)
-    Release(di_ptr)
-
-    if hr < 0:
-        raise RuntimeError(f"EnumDevices failed (HRESULT=0x{hr & 0xFFFFFFFF:08X})")
 
     return results
 
@@ -283,53 +332,79 @@ def print_directinput_files(files):
         print(f"  {f}")
     print("-------------------------------\n")
 
-def print_planned_changes(plans, okb_root: Path):
+def print_planned_changes(plans, okb_root: Path, buf=None):
     """
     plans: list of dicts:
       {
         'file': Path,
         'changes': [ {kind, name, from_key, from_id, to} ... ],
-        'new_data': dict
+        'new_bytes': bytes,   # encoded updated JSON
+        'raw_bytes': bytes,   # original file content
+        'mtime': float,
       }
+    buf: where to write (default sys.stdout); pass a StringIO to emit everything in one write
     """
-    print("Planned changes (what would be updated):")
-    print("---------------------------------------")
+    if buf is None:
+        buf = sys.stdout
+    print("Planned changes (what would be updated):", file=buf)
+    print("---------------------------------------", file=buf)
     if not plans:
-        print("  (none)")
-        print("---------------------------------------\n")
+        print("  (none)", file=buf)
+        print("---------------------------------------\n", file=buf)
         return
 
+    root_len = len(root_prefix(okb_root))
     total = 0
     for plan in plans:
-        rel = plan["file"].relative_to(okb_root)
+        rel = str(plan["file"])[root_len:]
         ch = plan["changes"]
         if not ch:
             continue
         total += len(ch)
-        print(f"{rel}  ({len(ch)} change(s))")
+        print(f"{rel}  ({len(ch)} change(s))", file=buf)
         for c in ch:
             # show the *original JSON name* (not normalized)
-            print(f"  - [{c['kind']}] {c['name']}")
-            print(f"    key: {c['from_key']} -> {c['to']}")
+            print(f"  - [{c['kind']}] {c['name']}", file=buf)
+            print(f"    key: {c['from_key']} -> {c['to']}", file=buf)
             # Only show ID if it differs or exists
             if c["from_id"] != c["to"]:
-                print(f"    id : {c['from_id']} -> {c['to']}")
-        print()
-    print(f"Total changes: {total}")
-    print("---------------------------------------\n")
+                print(f"    id : {c['from_id']} -> {c['to']}", file=buf)
+        print(file=buf)
+    print(f"Total changes: {total}", file=buf)
+    print("---------------------------------------\n", file=buf)
 
 # ============================================================
 # JSON processing (collect detailed plan)
 # ============================================================
 
-def build_plan_for_file(path: Path, device_map):
+def _find_directinput(root: str):
+    """
+    Yields the path (str) of every DirectInput.json below root.
+    Plain os.scandir walk; hidden (dot) directories are skipped.
+    """
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        if not e.name.startswith("."):
+                            stack.append(e.path)
+                    elif e.name == "DirectInput.json":
+                        yield e.path
+        except OSError:
+            # unreadable folder (permissions etc.): skip it like rglob did
+            continue
+
+def plan_content(raw: bytes, device_map):
     """
     Returns:
-      None if no changes needed
-      else dict with {file, changes[], new_data}
+      None if no changes needed (or raw isn't valid JSON)
+      else (changes[], new_bytes)
     """
     try:
-        data = json.loads(path.read_text(encoding="utf-8"))
+        # json.loads takes bytes directly; no separate decode step
+        data = json.loads(raw)
     except Exception:
         return None
 
@@ -380,68 +455,228 @@ def build_plan_for_file(path: Path, device_map):
     if not changes:
         return None
 
-    new_data = dict(data)
-    new_data["Devices"] = new_devices
-    return {"file": path, "changes": changes, "new_data": new_data}
+    # data was parsed here and isn't shared, so update it in place instead of copying
+    data["Devices"] = new_devices
+    # Encode once here; the dict tree isn't needed after that
+    return changes, dump_json(data)
+
+def build_plan_for_file(path: Path, device_map, cache=None):
+    """
+    Returns:
+      None if no changes needed
+      False if the file could not be read
+      else dict with {file, changes[], new_bytes, raw_bytes, mtime}
+    cache: optional dict shared between calls, so files with identical content
+    are parsed and re-encoded only once
+    """
+    try:
+        with path.open("rb") as f:
+            raw = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime
+    except OSError:
+        return False
+
+    if cache is None:
+        content = plan_content(raw, device_map)
+    else:
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+        if digest in cache:
+            content = cache[digest]
+        else:
+            content = cache[digest] = plan_content(raw, device_map)
+
+    if content is None:
+        return None
+    changes, new_bytes = content
+
+    # raw bytes + mtime let the ZIP backup skip reading the file a second time
+    return {
+        "file": path,
+        "changes": changes,
+        "new_bytes": new_bytes,
+        "raw_bytes": raw,
+        "mtime": mtime,
+    }
+
+def apply_plan(plan):
+    # Write next to the target, then rename over it: a crash never leaves a half-written file
+    p = plan["file"]
+    tmp = p.with_suffix(p.suffix + ".tmp")
+    try:
+        tmp.write_bytes(plan["new_bytes"])
+        os.replace(tmp, p)
+    except BaseException:
+        try:
+            tmp.unlink(missing_ok=True)
+        except OSError:
+            pass
+        raise
+
+def write_backup_zip(plans, okb_root: Path, backup_root: Path) -> Path:
+    """
+    ZIP the original content of every file in plans into a timestamped archive.
+    """
+    # Imported here: dry runs and no-change runs never need it
+    import zipfile
+
+    ts = time.strftime("%Y-%m-%d_%H-%M-%S")
+    zip_path = backup_root / f"{ZIP_PREFIX}_{ts}.zip"
+
+    # Small JSON files: compression isn't worth the CPU. Otherwise prefer zstd (Python 3.14+),
+    # then fast deflate.
+    total = sum(len(plan["raw_bytes"]) for plan in plans)
+    if total < ZIP_STORE_BELOW_TOTAL:
+        compression, level = zipfile.ZIP_STORED, None
+    elif hasattr(zipfile, "ZIP_ZSTANDARD"):
+        compression, level = zipfile.ZIP_ZSTANDARD, 3
+    else:
+        compression, level = zipfile.ZIP_DEFLATED, ZIP_DEFLATE_LEVEL
+
+    # 1 MiB buffered sink: many small entries coalesce into few write() calls
+    with open(zip_path, "wb", buffering=ZIP_WRITE_BUFFER) as raw, \
+            zipfile.ZipFile(raw, "w", compression, allowZip64=True, compresslevel=level) as zf:
+        root_len = len(root_prefix(okb_root))
+        for plan in plans:
+            arcname = str(plan["file"])[root_len:]
+            zi = zipfile.ZipInfo(arcname, time.localtime(plan["mtime"])[:6])
+            zf.writestr(zi, plan["raw_bytes"], compress_type=compression, compresslevel=level)
+
+    return zip_path
+
+# ============================================================
+# Unchanged-file cache
+# ============================================================
+
+def device_map_fingerprint(device_map) -> str:
+    # A file that needed no change only stays that way while the attached devices are the same
+    items = sorted((kind, name, guids) for (kind, name), guids in device_map.items())
+    return hashlib.blake2b(json.dumps(items).encode("utf-8"), digest_size=16).hexdigest()
+
+def load_unchanged_cache(backup_root: Path, fingerprint: str):
+    """
+    Returns {path_str: [mtime_ns, size]} of files that needed no change on a previous run
+    with the same devices, or {} if there is no usable cache.
+    """
+    try:
+        data = json.loads((backup_root / UNCHANGED_CACHE_NAME).read_bytes())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("devices") != fingerprint:
+        return {}
+    files = data.get("files")
+    return files if isinstance(files, dict) else {}
+
+def save_unchanged_cache(backup_root: Path, fingerprint: str, files) -> None:
+    try:
+        (backup_root / UNCHANGED_CACHE_NAME).write_text(
+            json.dumps({"devices": fingerprint, "files": files}), encoding="utf-8"
+        )
+    except OSError as e:
+        print(f"Warning: could not write {UNCHANGED_CACHE_NAME}: {e}")
+
+def stat_key(path: Path):
+    # None if the file went away (e.g. OpenKneeboard saving its profile); it is never cached
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
 
 # ============================================================
 # Main
 # ============================================================
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     okb_root, backup_root = load_ini()
-    dry_run = ask_mode(DEFAULT_DRY_RUN)
+    if args.dry_run:
+        dry_run = True
+    elif args.yes:
+        dry_run = False
+    else:
+        dry_run = ask_mode(DEFAULT_DRY_RUN)
+    # Only wait for ENTER when a human picked the mode
+    interactive = not (args.yes or args.dry_run)
 
     print(f"\nOpenKneeboard root : {okb_root}")
     print(f"Backup root        : {backup_root}")
     print(f"Mode               : {'DRY-RUN' if dry_run else 'REPLACE'}\n")
 
-    device_map = enumerate_directinput_devices()
+    # Device enumeration and the folder walk are independent; run them side by side
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_devices = ex.submit(enumerate_directinput_devices)
+        fut_files = ex.submit(lambda: sorted(_find_directinput(str(okb_root)), key=str.lower))
+        device_map = fut_devices.result()
+        json_files = [Path(p) for p in fut_files.result()]
     # print_enumerated_devices(device_map)
-
-    json_files = sorted(okb_root.rglob("DirectInput.json"))
     # _directinput_files(json_files)
 
     if not json_files:
         print("No DirectInput.json files found.")
-        wait_for_key()
+        if interactive:
+            wait_for_key()
         return
 
-    plans = []
-    for f in json_files:
-        plan = build_plan_for_file(f, device_map)
-        if plan:
-            plans.append(plan)
+    # Skip files whose mtime/size match a previous no-change run with the same devices
+    fingerprint = device_map_fingerprint(device_map)
+    unchanged = load_unchanged_cache(backup_root, fingerprint)
+    stats = {f: stat_key(f) for f in json_files}
+    todo = [f for f in json_files if stats[f] is None or unchanged.get(str(f)) != stats[f]]
+
+    # Files are independent and device_map is read-only; ex.map keeps input order.
+    # Profiles often share identical DirectInput.json content; plan_cache handles those once.
+    plan_cache = {}
+    with ThreadPoolExecutor(max_workers=args.jobs or min(32, (os.cpu_count() or 1) * 4)) as ex:
+        results = dict(zip(todo, ex.map(lambda f: build_plan_for_file(f, device_map, plan_cache), todo)))
+    plans = [p for p in results.values() if p]
+
+    # Cache only files known to need no change; one that failed to read is retried next run.
+    # Like the hash cache, this is only written in replace mode so a dry run changes nothing.
+    unchanged = {
+        str(f): stats[f]
+        for f in json_files
+        if stats[f] is not None and (f not in results or results[f] is None)
+    }
+    if not dry_run:
+        save_unchanged_cache(backup_root, fingerprint, unchanged)
 
     # Show what would change (this is what you asked for)
-    print_planned_changes(plans, okb_root)
+    if not args.quiet:
+        buf = io.StringIO()
+        print_planned_changes(plans, okb_root, buf)
+        sys.stdout.write(buf.getvalue())
 
     if not plans:
         print("No changes required.")
-        wait_for_key()
+        if interactive:
+            wait_for_key()
         return
 
-    # ZIP backup (original files that will be changed)
-    ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    zip_path = backup_root / f"{ZIP_PREFIX}_{ts}.zip"
-
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        for plan in plans:
-            p = plan["file"]
-            zf.write(p, p.relative_to(okb_root))
-
-    print(f"Backup written: {zip_path}")
+    if dry_run:
+        print(f"Dry-run: would back up {len(plans)} file(s) to {backup_root}")
+        print("Dry-run: no files modified.")
+    else:
+        # ZIP backup (original files that will be changed)
+        if args.no_backup:
+            print("Backup skipped (--no-backup).")
+        else:
+            zip_path = write_backup_zip(plans, okb_root, backup_root)
+            print(f"Backup written: {zip_path}")
+
+        # Independent files: overlap the per-file write latency
+        with ThreadPoolExecutor(max_workers=args.jobs or 8) as ex:
+            list(ex.map(apply_plan, plans))
+        print("Changes applied.")
 
-    if not dry_run:
+        # The files just written now match the devices too
         for plan in plans:
-            p = plan["file"]
-            new_data = plan["new_data"]
-            p.write_text(json.dumps(new_data, indent=2) + "\n", encoding="utf-8")
-        print("Changes applied.")
-    else:
-        print("Dry-run: no files modified.")
+            key = stat_key(plan["file"])
+            if key is not None:
+                unchanged[str(plan["file"])] = key
+        save_unchanged_cache(backup_root, fingerprint, unchanged)
 
-    wait_for_key()
+    if interactive:
+        wait_for_key()
 
 if __name__ == "__main__":
     main()